@@ -1,6 +1,7 @@
 from pathlib import Path
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 
 import librosa
@@ -13,6 +14,7 @@ import time
 import json
 
 def preprocess(gt_data, length, pitch_shift=0):
+    # Every frame label is [onset, offset, octave, pitch class, unclamped midi pitch (0 if no pitch)]
 
     new_label = []
 
@@ -36,24 +38,24 @@ def preprocess(gt_data, length, pitch_shift=0):
             if i == 0 or new_label[-1][0] != 1:
                 my_oct = int(min(max(octave_start, (cur_note_pitch- 36)//pitch_class_num), octave_end)) - octave_start
                 my_pitch_class = cur_note_pitch % pitch_class_num
-                label = [1, 0, my_oct, my_pitch_class]
+                label = [1, 0, my_oct, my_pitch_class, cur_note_pitch]
                 new_label.append(label)
             else:
                 my_oct = int(min(max(octave_start, (cur_note_pitch- 36)//pitch_class_num), octave_end)) - octave_start
                 my_pitch_class = cur_note_pitch % pitch_class_num
-                label = [0, 0, my_oct, my_pitch_class]
+                label = [0, 0, my_oct, my_pitch_class, cur_note_pitch]
                 new_label.append(label)
 
         elif cur_time < cur_note_onset or cur_note >= len(gt_data):
             # For the frame that doesn't belong to any note
-            label = [0, 1, octave_end+1, pitch_class_num]
+            label = [0, 1, octave_end+1, pitch_class_num, 0]
             new_label.append(label)
 
         elif abs(cur_time - cur_note_offset) <= (frame_size / 2.0):
             # For the offset frame
             my_oct = int(min(max(octave_start, (cur_note_pitch- 36)//pitch_class_num), octave_end)) - octave_start
             my_pitch_class = cur_note_pitch % pitch_class_num
-            label = [0, 1, my_oct, my_pitch_class]
+            label = [0, 1, my_oct, my_pitch_class, cur_note_pitch]
 
             cur_note = cur_note + 1
             if cur_note < len(gt_data):
@@ -67,6 +69,7 @@ def preprocess(gt_data, length, pitch_shift=0):
                     label[1] = 0
                     label[2] = my_oct
                     label[3] = my_pitch_class
+                    label[4] = cur_note_pitch
 
             new_label.append(label)
 
@@ -75,12 +78,70 @@ def preprocess(gt_data, length, pitch_shift=0):
             my_oct = int(min(max(octave_start, (cur_note_pitch- 36)//pitch_class_num), octave_end)) - octave_start
             my_pitch_class = cur_note_pitch % pitch_class_num
 
-            label = [0, 0, my_oct, my_pitch_class]
+            label = [0, 0, my_oct, my_pitch_class, cur_note_pitch]
             new_label.append(label)
 
     return np.array(new_label)
 
 
+class PitchShiftCollate:
+    """Collate function that randomly pitch-shifts training samples in CQT space.
+
+    Every sample is shifted by a whole number of semitones in [-max_shift, max_shift]: its CQT bins
+    move by 2 bins per semitone (24 bins per octave) and its label moves the same way
+    preprocess(pitch_shift=...) would move it. It runs inside the DataLoader workers on each batch,
+    so no shifted copies are computed or stored beforehand.
+
+    The label is rebuilt from the unclamped midi pitch preprocess stores in its last column. Datasets
+    built before that column existed only carry the clamped octave, so there samples in the edge
+    octaves (0 and 3) are not shifted.
+    """
+
+    def __init__(self, max_shift=2, bins_per_semitone=2):
+        self.max_shift = max_shift
+        self.bins_per_semitone = bins_per_semitone
+
+    def __call__(self, batch):
+        # features: [batch, 1, 11, 168], labels: [batch, 5]
+        features, labels = default_collate(batch)
+        if self.max_shift == 0:
+            return features, labels
+
+        shifts = torch.randint(-self.max_shift, self.max_shift + 1, (features.shape[0],))
+        # Frames without pitch (class 12) keep their label
+        voiced = labels[:, 3] != 12
+
+        if labels.shape[1] > 4:
+            pitch = labels[:, 4] + shifts
+        else:
+            # The octave may have been clamped, the pitch can't be recovered
+            shifts[voiced & ((labels[:, 2] == 0) | (labels[:, 2] == 3))] = 0
+            pitch = 36 + labels[:, 2] * 12 + labels[:, 3] + shifts
+
+        for shift in shifts.unique().tolist():
+            if shift == 0:
+                continue
+            idx = (shifts == shift).nonzero(as_tuple=True)[0]
+            shift_bins = shift * self.bins_per_semitone
+
+            # Move along the CQT bin axis, padding with zeros
+            shifted = torch.zeros_like(features[idx])
+            if shift_bins > 0:
+                shifted[..., shift_bins:] = features[idx][..., :-shift_bins]
+            else:
+                shifted[..., :shift_bins] = features[idx][..., -shift_bins:]
+            features[idx] = shifted
+
+        # Same octave / pitch class mapping as preprocess
+        labels = labels.clone()
+        labels[voiced, 2] = torch.clamp(torch.div(pitch - 36, 12, rounding_mode='floor'), 0, 3)[voiced]
+        labels[voiced, 3] = (pitch % 12)[voiced]
+        if labels.shape[1] > 4:
+            labels[voiced, 4] = pitch[voiced]
+
+        return features, labels
+
+
 def get_cqt(y, filter_scale=1):
     return np.abs(librosa.cqt(y, sr=44100, hop_length=1024, fmin=librosa.midi_to_hz(36)
         , n_bins=84*2, bins_per_octave=12*2, filter_scale=filter_scale)).T
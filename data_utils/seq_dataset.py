@@ -1,5 +1,6 @@
 from pathlib import Path
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
@@ -39,32 +40,19 @@ class SeqDataset(Dataset):
         if do_svs == True:
             y, sr = do_svs_spleeter(y, sr)
 
-        self.data_instances = []
+        self.song_id = song_id
 
         cqt_data = get_feature(y)
 
-        frame_size = 1024.0 / 44100.0
-
-        frame_num, channel_num, cqt_size = cqt_data.shape[0], cqt_data.shape[1], cqt_data.shape[2]
-
-        my_padding = torch.zeros((cqt_data.shape[1], cqt_data.shape[2]), dtype=torch.float)
-
-        for frame_idx in range(frame_num):
-            cqt_feature = []
-            for frame_window_idx in range(frame_idx - 5, frame_idx + 6):
-                # padding with zeros if needed
-                if frame_window_idx < 0 or frame_window_idx >= frame_num:
-                    cqt_feature.append(my_padding.unsqueeze(1))
-                else:
-                    choosed_idx = frame_window_idx
-                    cqt_feature.append(cqt_data[choosed_idx].unsqueeze(1))
-
-            cqt_feature = torch.cat(cqt_feature, dim=1)
-            self.data_instances.append((cqt_feature, song_id))
+        # Build all 11-frame windows at once as a single contiguous tensor so that
+        # inference can slice batches directly instead of collating per-frame items.
+        # [frame_num, 1, 11, 168], padding with zeros at both ends
+        padded = F.pad(cqt_data.permute(1, 2, 0), (5, 5))
+        self.features = padded.unfold(2, 11, 1).permute(2, 0, 3, 1).contiguous()
 
 
     def __getitem__(self, idx):
-        return self.data_instances[idx]
+        return self.features[idx], self.song_id
 
     def __len__(self):
-        return len(self.data_instances)
+        return self.features.shape[0]
@@ -0,0 +1,74 @@
+"""Decode frame-level model outputs into notes.
+
+Kept free of torch so it can be used by processes that never run the model (see evaluate.py).
+"""
+import numpy as np
+
+# Same as librosa.frames_to_time(1, sr=44100, hop_length=1024), without importing librosa
+FRAME_LENGTH = 1024 / 44100
+
+
+def parse_frame_info(frame_info, onset_thres, offset_thres):
+    """Parse frame info [(onset_probs, offset_probs, pitch_class)...] into desired label format."""
+
+    result = []
+    current_onset = None
+    pitch_counter = []
+
+    last_onset = 0.0
+    onset_seq = np.array([frame_info[i][0] for i in range(len(frame_info))])
+
+    local_max_size = 3
+    current_time = 0.0
+
+    onset_seq_length = len(onset_seq)
+
+    for i in range(len(frame_info)):
+
+        current_time = FRAME_LENGTH*i
+        info = frame_info[i]
+
+        backward_frames = i - local_max_size
+        if backward_frames < 0:
+            backward_frames = 0
+
+        forward_frames = i + local_max_size + 1
+        if forward_frames > onset_seq_length - 1:
+            forward_frames = onset_seq_length - 1
+
+        # local max and more than threshold
+        if info[0] >= onset_thres and onset_seq[i] == np.amax(onset_seq[backward_frames : forward_frames]):
+
+            if current_onset is None:
+                current_onset = current_time
+                last_onset = info[0] - onset_thres
+
+            else:
+                if len(pitch_counter) > 0:
+                    result.append([current_onset, current_time, max(set(pitch_counter), key=pitch_counter.count) + 36])
+
+                current_onset = current_time
+                last_onset = info[0] - onset_thres
+                pitch_counter = []
+
+        elif info[1] >= offset_thres:  # If is offset
+            if current_onset is not None:
+                if len(pitch_counter) > 0:
+                    result.append([current_onset, current_time, max(set(pitch_counter), key=pitch_counter.count) + 36])
+                current_onset = None
+
+                pitch_counter = []
+
+        # If current_onset exist, add count for the pitch
+        if current_onset is not None:
+            final_pitch = int(info[2]* 12 + info[3])
+            if info[2] != 4 and info[3] != 12:
+            # if final_pitch != 60:
+                pitch_counter.append(final_pitch)
+
+    if current_onset is not None:
+        if len(pitch_counter) > 0:
+            result.append([current_onset, current_time, max(set(pitch_counter), key=pitch_counter.count) + 36])
+        current_onset = None
+
+    return result
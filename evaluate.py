@@ -0,0 +1,228 @@
+"""Evaluate the predictor on a labeled test set and sweep the decoding thresholds.
+
+The model runs once per song and the raw frame outputs are cached (optionally on
+disk). Every (onset, offset) threshold pair is then decoded and scored in parallel
+worker processes, so tuning does not need to repeat inference.
+
+The ground truth uses the same JSON format as AudioDataset:
+    {"<song dir>": [[onset_sec, offset_sec, midi_pitch], ...], ...}
+with the audio at <data_dir>/<song dir>/Vocal.wav.
+
+Example:
+    python evaluate.py gt.json test_data models/1005_e_4 --frame_cache frames.pkl
+    python evaluate.py gt.json test_data models/small_1 --model_type small
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+
+from decoding import parse_frame_info
+
+ONSET_TOLERANCE = 0.05
+OFFSET_RATIO = 0.2
+OFFSET_MIN_TOLERANCE = 0.05
+# In cents
+PITCH_TOLERANCE = 50.0
+
+METRIC_NAMES = ('COn', 'COnP', 'COnPOff')
+
+
+def _notes_to_arrays(notes):
+    """Convert [[onset, offset, midi_pitch], ...] into mir_eval (intervals, pitches in Hz).
+
+    Notes without a positive duration are dropped, mir_eval rejects them. The decoder can emit one when
+    an onset is detected on the last frame.
+    """
+    import mir_eval
+
+    notes = [note for note in notes if note[1] > note[0]]
+    if len(notes) == 0:
+        return np.zeros((0, 2)), np.zeros(0)
+    notes = np.array(notes, dtype=float)
+    return notes[:, 0:2], mir_eval.util.midi_to_hz(notes[:, 2])
+
+
+def note_metrics(ref_notes, est_notes):
+    """Compute note-level precision, recall and F1 for a single song with mir_eval.
+
+    Returns {'COn': (p, r, f), 'COnP': (p, r, f), 'COnPOff': (p, r, f)}, where COn only
+    checks onsets, COnP also checks pitch and COnPOff also checks offsets.
+    """
+    import mir_eval
+
+    ref_intervals, ref_pitches = _notes_to_arrays(ref_notes)
+    est_intervals, est_pitches = _notes_to_arrays(est_notes)
+
+    metrics = {}
+    metrics['COn'] = mir_eval.transcription.onset_precision_recall_f1(
+        ref_intervals, est_intervals, onset_tolerance=ONSET_TOLERANCE)
+    metrics['COnP'] = mir_eval.transcription.precision_recall_f1_overlap(
+        ref_intervals, ref_pitches, est_intervals, est_pitches, onset_tolerance=ONSET_TOLERANCE,
+        pitch_tolerance=PITCH_TOLERANCE, offset_ratio=None)[:3]
+    metrics['COnPOff'] = mir_eval.transcription.precision_recall_f1_overlap(
+        ref_intervals, ref_pitches, est_intervals, est_pitches, onset_tolerance=ONSET_TOLERANCE,
+        pitch_tolerance=PITCH_TOLERANCE, offset_ratio=OFFSET_RATIO, offset_min_tolerance=OFFSET_MIN_TOLERANCE)[:3]
+    return metrics
+
+
+def collect_frames(predictor, gt, data_dir):
+    """Run the model once for every labeled song.
+
+    Returns ({song_id: frame_info}, feature_time, inference_time), where feature_time covers loading the
+    audio and computing the CQT, and inference_time only covers the model.
+    """
+    from data_utils.seq_dataset import SeqDataset
+
+    song_frames = {}
+    feature_time = 0.0
+    inference_time = 0.0
+    for the_dir in sorted(os.listdir(data_dir)):
+        if the_dir not in gt:
+            continue
+        wav_path = os.path.join(data_dir, the_dir, "Vocal.wav")
+
+        start_time = time.perf_counter()
+        test_dataset = SeqDataset(wav_path, song_id=the_dir)
+        feature_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        song_frames.update(predictor.predict_frames(test_dataset))
+        inference_time += time.perf_counter() - start_time
+    return song_frames, feature_time, inference_time
+
+
+_worker_frames = None
+_worker_gt = None
+
+
+def _init_worker(song_frames, gt):
+    # The cached frames are sent once per worker instead of once per threshold pair
+    global _worker_frames, _worker_gt
+    _worker_frames = song_frames
+    _worker_gt = gt
+
+
+def _evaluate_thresholds(thresholds):
+    onset_thres, offset_thres = thresholds
+    total = {name: np.zeros(3) for name in METRIC_NAMES}
+    for song_id, frame_info in _worker_frames.items():
+        est_notes = parse_frame_info(frame_info, onset_thres=onset_thres, offset_thres=offset_thres)
+        song_metrics = note_metrics(_worker_gt[song_id], est_notes)
+        for name in METRIC_NAMES:
+            total[name] += song_metrics[name]
+
+    song_count = max(len(_worker_frames), 1)
+    return {
+        'onset_thres': onset_thres,
+        'offset_thres': offset_thres,
+        'metrics': {name: (total[name] / song_count).tolist() for name in METRIC_NAMES},
+    }
+
+
+def sweep_thresholds(song_frames, gt, onset_thresholds, offset_thresholds, num_workers=None):
+    """Decode and score the cached frames for every threshold pair in parallel.
+
+    Scores are averaged over songs. Results are sorted by COnPOff F1, best first.
+    """
+    grid = [(onset_thres, offset_thres) for onset_thres in onset_thresholds for offset_thres in offset_thresholds]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                                initargs=(song_frames, gt)) as executor:
+        results = list(executor.map(_evaluate_thresholds, grid))
+
+    results.sort(key=lambda result: result['metrics']['COnPOff'][2], reverse=True)
+    return results
+
+
+def _parse_grid(value):
+    # Accepts either "0.1,0.2,0.3" or "start:stop:step" (stop inclusive)
+    if ':' in value:
+        start, stop, step = (float(v) for v in value.split(':'))
+        return [round(v, 4) for v in np.arange(start, stop + step / 2, step)]
+    return [float(v) for v in value.split(',')]
+
+
+def main(args):
+    with open(args.gt_path) as json_data:
+        gt = json.load(json_data)
+
+    model_info = {'model_path': os.path.abspath(args.model_path), 'model_type': args.model_type}
+
+    if args.frame_cache is not None and Path(args.frame_cache).exists():
+        print('Reading cached frames from {}.'.format(args.frame_cache))
+        with open(args.frame_cache, 'rb') as f:
+            cache = pickle.load(f)
+        cached_info = {key: cache.get(key) for key in model_info}
+        if cached_info != model_info:
+            raise ValueError('Frame cache {} was computed with {}, not {}.'.format(
+                args.frame_cache, cached_info, model_info))
+        song_frames = cache['song_frames']
+        print('Inference speed is not measured when reading cached frames.')
+    else:
+        import torch
+        from predictor import EffNetPredictor
+
+        device = args.device
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        predictor = EffNetPredictor(device=device, model_path=args.model_path, model_type=args.model_type)
+        predictor.warm_up()
+
+        song_frames, feature_time, inference_time = collect_frames(predictor, gt, args.data_dir)
+        frame_count = sum(len(frame_info) for frame_info in song_frames.values())
+        print('Features computed in {:.1f} seconds, model inference done in {:.1f} seconds ({:.0f} frames/s).'.format(
+            feature_time, inference_time, frame_count / max(inference_time, 1e-9)))
+
+        if args.frame_cache is not None:
+            with open(args.frame_cache, 'wb') as f:
+                pickle.dump(dict(model_info, song_frames=song_frames), f)
+
+    # Only score songs that have both frames and ground truth
+    missing_gt = sorted(song_id for song_id in song_frames if song_id not in gt)
+    if len(missing_gt) > 0:
+        print('Skipping {} songs without ground truth: {}'.format(len(missing_gt), ', '.join(missing_gt)))
+    missing_frames = sorted(song_id for song_id in gt if song_id not in song_frames)
+    if len(missing_frames) > 0:
+        print('No audio found for {} labeled songs: {}'.format(len(missing_frames), ', '.join(missing_frames)))
+    song_frames = {song_id: frame_info for song_id, frame_info in song_frames.items() if song_id in gt}
+
+    onset_thresholds = _parse_grid(args.onset_thresholds)
+    offset_thresholds = _parse_grid(args.offset_thresholds)
+
+    start_time = time.time()
+    results = sweep_thresholds(song_frames, gt, onset_thresholds, offset_thresholds, num_workers=args.num_workers)
+    print('Evaluated {} threshold pairs on {} songs in {:.1f} seconds.'.format(
+        len(results), len(song_frames), time.time() - start_time))
+
+    print('onset  offset | COn P/R/F            | COnP P/R/F           | COnPOff P/R/F')
+    for result in results[:args.top]:
+        print('{:5.2f}  {:6.2f} | {}'.format(
+            result['onset_thres'],
+            result['offset_thres'],
+            ' | '.join('{:.4f} {:.4f} {:.4f}'.format(*result['metrics'][name]) for name in METRIC_NAMES)))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gt_path')
+    parser.add_argument('data_dir')
+    parser.add_argument('model_path')
+    parser.add_argument('--model_type', default='effnet', choices=['effnet', 'small'])
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--frame_cache', default=None, help='Pickle file to read/write the cached frame outputs')
+    parser.add_argument('--onset_thresholds', default='0.1:0.9:0.1')
+    parser.add_argument('--offset_thresholds', default='0.1:0.9:0.1')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--top', type=int, default=10, help='Number of best threshold pairs to print')
+    parser.add_argument('--output', default=None, help='Optional JSON file for the full sweep results')
+
+    main(parser.parse_args())
@@ -0,0 +1,48 @@
+"""Gunicorn settings for serving the plugin with one model shared by all workers.
+
+    gunicorn local_app:app
+
+On CPU nodes the app (and the model with it) is loaded once in the master, then workers
+are forked and share the weights instead of loading their own copy. Each worker warms up
+the model and tunes its batch size after its thread count is set.
+
+The master must never initialize CUDA: a CUDA context created before fork breaks CUDA in every
+worker. PRELOAD_MODEL=1 or 0 picks the mode explicitly (only use 1 on CPU nodes). Otherwise GPUs
+are detected with PYTORCH_NVML_BASED_CUDA_CHECK=1, which asks NVML instead of initializing CUDA.
+"""
+import gc
+import os
+
+import torch
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = 'uvicorn.workers.UvicornWorker'
+# Only preload the model on CPU nodes, see the module docstring
+if 'PRELOAD_MODEL' in os.environ:
+    preload_app = os.environ['PRELOAD_MODEL'] == '1'
+else:
+    os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+    preload_app = not torch.cuda.is_available()
+# Split the cores between workers instead of every worker using all of them. Also set here, before the
+# app is preloaded, so the master loads the weights with the same thread count the workers use.
+threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+torch.set_num_threads(threads_per_worker)
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before any worker is forked
+    if not preload_app:
+        return
+    import plugin
+    plugin.share_predictor()
+    # Keep the garbage collector from touching (and copying) the objects inherited by workers
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // server.cfg.workers))
+    if preload_app:
+        # Tune the batch size for the threads this worker actually has
+        import plugin
+        plugin.predictor.warm_up()
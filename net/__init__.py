@@ -1,2 +1,3 @@
 # from .effnet import EffNet, EffNetb0, EffNetb0_extralayer, EffNetb0_withrnn
-from .effnet import EffNetb0
\ No newline at end of file
+from .effnet import EffNetb0
+from .smallnet import SmallNet
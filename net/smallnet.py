@@ -0,0 +1,57 @@
+import torch.nn as nn
+import torch
+
+
+class SmallNet(nn.Module):
+    """Compact CNN with the same output heads as EffNetb0, meant to be distilled from it."""
+
+    def __init__(self, pitch_class=12, pitch_octave=4):
+        super(SmallNet, self).__init__()
+        self.model_name = 'smallnet'
+        self.pitch_octave = pitch_octave
+        self.pitch_class = pitch_class
+
+        # [batch, 1, 11, 168] -> [batch, 64, 6, 21]
+        self.conv = nn.Sequential(
+            nn.Conv2d(1, 16, kernel_size=3, padding=1, bias=False),
+            nn.BatchNorm2d(16),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(16, 32, kernel_size=3, stride=(1, 2), padding=1, bias=False),
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(32, 64, kernel_size=3, stride=(2, 2), padding=1, bias=False),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(64, 64, kernel_size=3, stride=(1, 2), padding=1, bias=False),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+        )
+        # Only pool over time, the position along the CQT bins carries the pitch
+        self.pool = nn.AdaptiveAvgPool2d((1, 21))
+        self.classifier = nn.Sequential(
+            nn.Linear(64 * 21, 256),
+            nn.ReLU(inplace=True),
+            nn.Dropout(0.2),
+            nn.Linear(256, 2+pitch_class+pitch_octave+2),
+        )
+
+    def forward(self, x):
+        out = self.pool(self.conv(x))
+        out = self.classifier(torch.flatten(out, 1))
+        # [batch, output_size]
+
+        onset_logits = out[:, 0]
+        offset_logits = out[:, 1]
+
+        pitch_out = out[:, 2:]
+
+        pitch_octave_logits = pitch_out[:, 0:self.pitch_octave+1]
+        pitch_class_logits = pitch_out[:, self.pitch_octave+1:]
+
+        return onset_logits, offset_logits, pitch_octave_logits, pitch_class_logits
+
+
+if __name__ == '__main__':
+    from torchsummary import summary
+    model = SmallNet()
+    summary(model, input_size=(1, 11, 168), device='cpu')
@@ -2,16 +2,35 @@ from __future__ import annotations
 
 from tuneflow_py import TuneflowPlugin, Song, ParamDescriptor, WidgetType, TrackType, InjectSource, Track, Clip, TuneflowPluginTriggerData, ClipAudioDataInjectData
 from typing import Any
-from data_utils.seq_dataset import SeqDataset
 from predictor import EffNetPredictor
 import torch
 from pathlib import Path
 import tempfile
+import os
 import traceback
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-predictor = EffNetPredictor(device=device, model_path=str(
-    Path(__file__).parent.joinpath("models").joinpath("1005_e_4").absolute()))
+# 'effnet' (default) or 'small', the faster distilled model. TRANSCRIPTION_MODEL_PATH sets the model file,
+# it defaults to the bundled 1005_e_4 for 'effnet' and is required for 'small'.
+model_type = os.environ.get("TRANSCRIPTION_MODEL_TYPE", "effnet")
+model_path = os.environ.get("TRANSCRIPTION_MODEL_PATH")
+if model_path is None:
+    if model_type != "effnet":
+        raise Exception("TRANSCRIPTION_MODEL_PATH is required for model type {}".format(model_type))
+    model_path = str(Path(__file__).parent.joinpath("models").joinpath("1005_e_4").absolute())
+predictor = EffNetPredictor(device=device, model_path=model_path, model_type=model_type)
+
+
+def share_predictor():
+    """Prepare the module-level predictor to be shared by forked workers.
+
+    Called once in the gunicorn master (see gunicorn.conf.py). Only the weights are moved into shared
+    memory here; the model is not run before fork; each worker warms it up with its own thread count.
+    """
+    # Import the feature extraction (librosa) before fork as well, so the first request doesn't pay for it
+    import data_utils.seq_dataset
+
+    predictor.model.share_memory()
 
 
 class TranscribeSinging(TuneflowPlugin):
@@ -136,6 +155,8 @@ class TranscribeSinging(TuneflowPlugin):
             clip_end_tick=audio_clip.get_clip_end_tick(),
             insert_clip=True
         )
+        from data_utils.seq_dataset import SeqDataset
+
         audio_clip_start_tick = audio_clip.get_clip_start_tick()
         audio_start_time = song.tick_to_seconds(audio_clip_start_tick)
         test_dataset = SeqDataset(audio_file_path, song_id='1', do_svs=do_separation)
@@ -1,41 +1,55 @@
 import torch
 import torch.nn as nn
-import torch.optim as optim
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
-import librosa
 import time
 from pathlib import Path
 import pickle
-from tqdm import tqdm
 from collections import Counter
 import numpy as np
 
 import sys
 import os
 
-from net import EffNetb0
+from net import EffNetb0, SmallNet
+from decoding import FRAME_LENGTH, parse_frame_info
 import math
-from data_utils import AudioDataset
 
-FRAME_LENGTH = librosa.frames_to_time(1, sr=44100, hop_length=1024)
+# Input window shape of a single frame: [channel, frames, cqt bins]
+WINDOW_SHAPE = (1, 11, 168)
+
+MODEL_CLASSES = {
+    'effnet': EffNetb0,
+    'small': SmallNet,
+}
 
 
 class EffNetPredictor:
-    def __init__(self, device= "cuda:0", model_path=None):
+    def __init__(self, device= "cuda:0", model_path=None, model_type='effnet'):
         """
         Params:
         model_path: Optional pretrained model file
+        model_type: 'effnet' (EffNetb0) or 'small' (SmallNet, the compact distilled model)
         """
         # Initialize model
         self.device = device
+        self.model_type = model_type
+        model_class = MODEL_CLASSES[model_type]
 
         if model_path is not None:
-            self.model = EffNetb0().to(self.device)
-            self.model.load_state_dict(torch.load(model_path, map_location=self.device), strict=False)
+            self.model = model_class().to(self.device)
+            # The original EffNetb0 checkpoints are loaded non-strictly, newer model types must match exactly
+            load_result = self.model.load_state_dict(torch.load(model_path, map_location=self.device),
+                                                     strict=(model_type != 'effnet'))
+            if set(load_result.missing_keys) >= set(self.model.state_dict().keys()):
+                raise ValueError('{} is not a {} model file.'.format(model_path, model_type))
             print('Model read from {}.'.format(model_path))
 
         else:            
-            self.model = EffNetb0().to(self.device)
+            self.model = model_class().to(self.device)
+
+        # Inference batch size, tuned on the first predict call (see _auto_batch_size)
+        self.inference_batch_size = None
 
         print('Predictor initialized.')
 
@@ -51,7 +65,15 @@ class EffNetPredictor:
           - epoch
           - lr
           - save_every_epoch
+          - pitch_shift: Optional, max random pitch shift (semitones) applied to training batches, default 0
+          - num_workers: Optional, number of training DataLoader workers, default 0
+          - teacher_model_path: Optional, EffNetb0 model file to distill from (e.g. models/1005_e_4)
+          - distill_alpha: Optional, weight of the distillation loss against the label loss, default 0.5
+          - distill_temperature: Optional, softening temperature of the teacher outputs, default 2.0
         """
+        import torch.optim as optim
+        from data_utils.audio_dataset import PitchShiftCollate
+
         # Set paths
         self.train_dataset_path = train_dataset_path
         self.valid_dataset_path = valid_dataset_path
@@ -64,6 +86,11 @@ class EffNetPredictor:
         self.epoch = training_args['epoch']
         self.lr = training_args['lr']
         self.save_every_epoch = training_args['save_every_epoch']
+        self.pitch_shift = training_args.get('pitch_shift', 0)
+        self.num_workers = training_args.get('num_workers', 0)
+        self.teacher_model_path = training_args.get('teacher_model_path', None)
+        self.distill_alpha = training_args.get('distill_alpha', 0.5)
+        self.distill_temperature = training_args.get('distill_temperature', 2.0)
 
         self.optimizer = optim.Adam(self.model.parameters(), lr=self.lr)
 
@@ -73,6 +100,11 @@ class EffNetPredictor:
         self.octave_criterion = nn.CrossEntropyLoss(ignore_index=100)
         self.pitch_criterion = nn.CrossEntropyLoss(ignore_index=100)
 
+        self.teacher = None
+        if self.teacher_model_path is not None:
+            self.teacher = EffNetPredictor(device=self.device, model_path=self.teacher_model_path).model
+            self.teacher.eval()
+
         # Read the datasets
         print('Reading datasets...')
         print ('cur time: %.6f' %(time.time()))
@@ -87,10 +119,11 @@ class EffNetPredictor:
         self.train_loader = DataLoader(
             self.training_dataset,
             batch_size=self.batch_size,
-            num_workers=0,
+            num_workers=self.num_workers,
             pin_memory=True,
             shuffle=True,
             drop_last=True,
+            collate_fn=PitchShiftCollate(max_shift=self.pitch_shift),
         )
 
         self.valid_loader = DataLoader(
@@ -142,6 +175,14 @@ class EffNetPredictor:
                 total_split_loss[3] = total_split_loss[3] + split_train_loss3.item()
 
                 loss = split_train_loss0 + split_train_loss1 + split_train_loss2 + split_train_loss3
+
+                if self.teacher is not None:
+                    with torch.no_grad():
+                        teacher_outputs = self.teacher(input_tensor)
+                    distill_loss = self._distillation_loss(
+                        (onset_logits, offset_logits, pitch_octave_logits, pitch_class_logits), teacher_outputs)
+                    loss = (1 - self.distill_alpha) * loss + self.distill_alpha * distill_loss
+
                 loss.backward()
                 self.optimizer.step()
                 total_training_loss += loss.item()
@@ -214,75 +255,148 @@ class EffNetPredictor:
                 )
         print('Training done in {:.1f} minutes.'.format((time.time()-start_time)/60))
 
-    def _parse_frame_info(self, frame_info, onset_thres, offset_thres):
-        """Parse frame info [(onset_probs, offset_probs, pitch_class)...] into desired label format."""
-
-        result = []
-        current_onset = None
-        pitch_counter = []
-
-        last_onset = 0.0
-        onset_seq = np.array([frame_info[i][0] for i in range(len(frame_info))])
-
-        local_max_size = 3
-        current_time = 0.0
-
-        onset_seq_length = len(onset_seq)
-
-        for i in range(len(frame_info)):
+    def _distillation_loss(self, student_outputs, teacher_outputs):
+        """Soft target loss between the student and teacher outputs of all four heads."""
+        temperature = self.distill_temperature
+
+        # Onset / offset heads are binary, use the softened teacher probabilities as BCE targets
+        loss = 0
+        for head in range(2):
+            loss = loss + F.binary_cross_entropy_with_logits(
+                student_outputs[head] / temperature, torch.sigmoid(teacher_outputs[head] / temperature))
+
+        # Pitch octave / pitch class heads
+        for head in range(2, 4):
+            loss = loss + F.kl_div(
+                F.log_softmax(student_outputs[head] / temperature, dim=1),
+                F.softmax(teacher_outputs[head] / temperature, dim=1),
+                reduction='batchmean')
+
+        return loss * temperature * temperature
+
+    def warm_up(self):
+        """Run the model and tune the inference batch size ahead of the first request."""
+        self._auto_batch_size()
+
+    def _auto_batch_size(self, latency_target=0.5, max_batch_size=1024, timed_runs=3):
+        """Pick the inference batch size from a short calibration run.
+
+        Batch sizes are tried in powers of two up to max_batch_size. Each size is run once untimed (so
+        one-time setup for a new shape isn't counted), then its latency is the best of timed_runs runs.
+        The size with the best throughput whose latency stays under latency_target seconds is kept.
+        On CUDA the calibration stops at the first batch size that runs out of memory; CPU memory is not
+        part of the calibration, max_batch_size bounds it there. The throughput curve reflects the cores
+        available to torch at this point, so the result is cached for the predictor lifetime.
+        """
+        if self.inference_batch_size is not None:
+            return self.inference_batch_size
 
-            current_time = FRAME_LENGTH*i
-            info = frame_info[i]
+        candidates = []
+        batch_size = 16
+        while batch_size <= max_batch_size:
+            candidates.append(batch_size)
+            batch_size *= 2
 
-            backward_frames = i - local_max_size
-            if backward_frames < 0:
-                backward_frames = 0
+        is_cuda = torch.device(self.device).type == 'cuda'
+        dummy_input = torch.zeros((candidates[-1],) + WINDOW_SHAPE, device=self.device)
 
-            forward_frames = i + local_max_size + 1
-            if forward_frames > onset_seq_length - 1:
-                forward_frames = onset_seq_length - 1
+        best_batch_size = candidates[0]
+        best_throughput = 0.0
+        self.model.eval()
+        with torch.no_grad():
+            for batch_size in candidates:
+                # Untimed run for the new shape
+                try:
+                    self.model(dummy_input[:batch_size])
+                    if is_cuda:
+                        torch.cuda.synchronize(self.device)
+                except RuntimeError as e:
+                    if 'out of memory' not in str(e):
+                        raise
+                    torch.cuda.empty_cache()
+                    break
+
+                latency = None
+                for _ in range(timed_runs):
+                    start_time = time.perf_counter()
+                    self.model(dummy_input[:batch_size])
+                    if is_cuda:
+                        torch.cuda.synchronize(self.device)
+                    run_latency = time.perf_counter() - start_time
+                    if latency is None or run_latency < latency:
+                        latency = run_latency
+
+                if latency > latency_target and batch_size != candidates[0]:
+                    break
+                if batch_size / latency > best_throughput:
+                    best_batch_size = batch_size
+                    best_throughput = batch_size / latency
+
+        self.inference_batch_size = best_batch_size
+        print('Inference batch size set to {}.'.format(best_batch_size))
+        return best_batch_size
+
+    def _predict_features(self, features, batch_size):
+        """Run the model over an in-memory [frame_num, 1, 11, 168] feature tensor, return its frame info.
+
+        Batches are sliced straight from the features (or copied into one device buffer), and outputs are
+        written into tensors allocated once per call, so nothing is collated or allocated per batch.
+        """
+        from tqdm import tqdm
 
-            # local max and more than threshold
-            if info[0] >= onset_thres and onset_seq[i] == np.amax(onset_seq[backward_frames : forward_frames]):
+        num_frames = features.shape[0]
+        batch_size = max(1, min(batch_size, num_frames))
+        copy_input = features.device != torch.device(self.device)
 
-                if current_onset is None:
-                    current_onset = current_time
-                    last_onset = info[0] - onset_thres
+        if copy_input:
+            input_buffer = torch.empty((batch_size,) + WINDOW_SHAPE, device=self.device)
+        onset_probs = torch.empty(num_frames, device=self.device)
+        offset_probs = torch.empty(num_frames, device=self.device)
+        pitch_octaves = torch.empty(num_frames, dtype=torch.long, device=self.device)
+        pitch_classes = torch.empty(num_frames, dtype=torch.long, device=self.device)
 
+        self.model.eval()
+        with torch.no_grad():
+            for start in tqdm(range(0, num_frames, batch_size)):
+                end = min(start + batch_size, num_frames)
+                if copy_input:
+                    input_tensor = input_buffer[:end - start]
+                    input_tensor.copy_(features[start:end])
                 else:
-                    if len(pitch_counter) > 0:
-                        result.append([current_onset, current_time, max(set(pitch_counter), key=pitch_counter.count) + 36])
+                    input_tensor = features[start:end]
 
-                    current_onset = current_time
-                    last_onset = info[0] - onset_thres
-                    pitch_counter = []
-
-            elif info[1] >= offset_thres:  # If is offset
-                if current_onset is not None:
-                    if len(pitch_counter) > 0:
-                        result.append([current_onset, current_time, max(set(pitch_counter), key=pitch_counter.count) + 36])
-                    current_onset = None
-
-                    pitch_counter = []
+                onset_logits, offset_logits, pitch_octave_logits, pitch_class_logits = self.model(input_tensor)
 
-            # If current_onset exist, add count for the pitch
-            if current_onset is not None:
-                final_pitch = int(info[2]* 12 + info[3])
-                if info[2] != 4 and info[3] != 12:
-                # if final_pitch != 60:
-                    pitch_counter.append(final_pitch)
+                torch.sigmoid(onset_logits, out=onset_probs[start:end])
+                torch.sigmoid(offset_logits, out=offset_probs[start:end])
+                torch.argmax(pitch_octave_logits, dim=1, out=pitch_octaves[start:end])
+                torch.argmax(pitch_class_logits, dim=1, out=pitch_classes[start:end])
+
+        # A single transfer for the whole song
+        return list(zip(
+            onset_probs.tolist(),
+            offset_probs.tolist(),
+            pitch_octaves.tolist(),
+            pitch_classes.tolist(),
+        ))
+
+    def predict_frames(self, test_dataset, batch_size=None):
+        """Run the model over a test dataset and collect raw frame info for every song.
+
+        Returns a dict mapping song_id to [(onset_prob, offset_prob, pitch_octave, pitch_class)...],
+        which can be decoded with different thresholds without running the model again.
+        batch_size: Inference batch size, tuned automatically when None
+        """
+        if batch_size is None:
+            batch_size = self._auto_batch_size()
 
-        if current_onset is not None:
-            if len(pitch_counter) > 0:
-                result.append([current_onset, current_time, max(set(pitch_counter), key=pitch_counter.count) + 36])
-            current_onset = None
+        # In-memory single song dataset (SeqDataset), bypass the DataLoader
+        features = getattr(test_dataset, 'features', None)
+        if features is not None:
+            return {test_dataset.song_id: self._predict_features(features, batch_size)}
 
-        return result
+        from tqdm import tqdm
 
-    def predict(self, test_dataset, results={}, onset_thres=0.1, offset_thres=0.5):
-        """Predict results for a given test dataset."""
-        # Setup params and dataloader
-        batch_size = 500
         test_loader = DataLoader(
             test_dataset,
             batch_size=batch_size,
@@ -292,11 +406,9 @@ class EffNetPredictor:
         )
 
         # Start predicting
-        my_sm = torch.nn.Softmax(dim=0)
         self.model.eval()
         with torch.no_grad():
             song_frames_table = {}
-            raw_data = {}
             for batch_idx, batch in enumerate(tqdm(test_loader)):
                 # Parse batch data
                 input_tensor = batch[0].to(self.device)
@@ -308,21 +420,25 @@ class EffNetPredictor:
                 pitch_octave_logits = result_tuple[2]
                 pitch_class_logits = result_tuple[3]
 
-                onset_probs, offset_probs = torch.sigmoid(onset_logits).cpu(), torch.sigmoid(offset_logits).cpu()
-                pitch_octave_logits, pitch_class_logits = pitch_octave_logits.cpu(), pitch_class_logits.cpu()
-                # print (pitch_octave_logits)
-
+                onset_probs = torch.sigmoid(onset_logits).tolist()
+                offset_probs = torch.sigmoid(offset_logits).tolist()
+                pitch_octaves = torch.argmax(pitch_octave_logits, dim=1).tolist()
+                pitch_classes = torch.argmax(pitch_class_logits, dim=1).tolist()
 
                 # Collect frames for corresponding songs
                 for bid, song_id in enumerate(song_ids):
-                    frame_info = (onset_probs[bid], offset_probs[bid], torch.argmax(pitch_octave_logits[bid]).item()
-                            , torch.argmax(pitch_class_logits[bid]).item())
+                    frame_info = (onset_probs[bid], offset_probs[bid], pitch_octaves[bid], pitch_classes[bid])
 
                     song_frames_table.setdefault(song_id, [])
                     song_frames_table[song_id].append(frame_info)
-                        
 
-            # Parse frame info into output format for every song
-            for song_id, frame_info in song_frames_table.items():
-                results[song_id] = self._parse_frame_info(frame_info, onset_thres=onset_thres, offset_thres=offset_thres)
+        return song_frames_table
+
+    def predict(self, test_dataset, results={}, onset_thres=0.1, offset_thres=0.5, batch_size=None):
+        """Predict results for a given test dataset."""
+        song_frames_table = self.predict_frames(test_dataset, batch_size=batch_size)
+
+        # Parse frame info into output format for every song
+        for song_id, frame_info in song_frames_table.items():
+            results[song_id] = parse_frame_info(frame_info, onset_thres=onset_thres, offset_thres=offset_thres)
         return results